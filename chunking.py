@@ -0,0 +1,71 @@
+"""
+Token counting and chunk estimation shared by the scraper and uploader.
+"""
+
+import tiktoken
+from typing import Optional
+
+# OpenAI's default static chunking strategy for vector stores
+MAX_CHUNK_TOKENS = 800
+CHUNK_OVERLAP_TOKENS = 400
+
+# Characters read per window when counting tokens in a file
+STREAM_WINDOW_CHARS = 64 * 1024
+
+# Initialize tiktoken encoding once (expensive operation)
+try:
+    ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    ENCODING = None
+
+
+def count_tokens(*parts: str) -> Optional[int]:
+    """Count tokens across text parts. Returns None if tiktoken is unavailable."""
+    if not ENCODING:
+        return None
+    return sum(len(ENCODING.encode(part)) for part in parts)
+
+
+def count_file_tokens(filepath: str) -> int:
+    """
+    Count tokens in a file in fixed-size windows instead of reading it whole.
+    Each window is cut at its last newline and the remainder carried into the
+    next one, so tokens are not split across window boundaries.
+    """
+    token_count = 0
+    carry = ""
+
+    with open(filepath, "r", encoding="utf-8") as f:
+        while block := f.read(STREAM_WINDOW_CHARS):
+            text = carry + block
+            cut = text.rfind("\n") + 1 or len(text)  # No newline: flush window
+            token_count += len(ENCODING.encode(text[:cut]))
+            carry = text[cut:]
+
+    if carry:
+        token_count += len(ENCODING.encode(carry))
+
+    return token_count
+
+
+def estimate_file_chunks(filepath: str) -> int:
+    """Estimate chunks for a single file."""
+    try:
+        return chunks_for_tokens(count_file_tokens(filepath))
+    except Exception:
+        return 1  # Fallback
+
+
+def chunks_for_tokens(token_count: int) -> int:
+    """
+    Calculate chunks based on OpenAI's strategy:
+    - max_chunk_size_tokens: 800
+    - chunk_overlap_tokens: 400
+    - Effective progression: 400 tokens per chunk (after first)
+    """
+    if token_count <= MAX_CHUNK_TOKENS:
+        return 1
+
+    step = MAX_CHUNK_TOKENS - CHUNK_OVERLAP_TOKENS
+    remaining_tokens = token_count - MAX_CHUNK_TOKENS
+    return 1 + (remaining_tokens + step - 1) // step  # Ceiling division
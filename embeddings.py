@@ -0,0 +1,105 @@
+"""
+Bulk embedding backfill through the OpenAI Batch API.
+Only used for first-run backfills; incremental runs stay on the real-time path.
+"""
+
+import os
+import time
+import orjson
+from typing import Dict, List, Optional, Union
+from chunking import ENCODING
+from uploader import client
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+BATCH_INPUT_FILE = "data/embeddings_batch_input.jsonl"
+EMBEDDINGS_FILE = "data/embeddings.jsonl"
+BATCH_POLL_INTERVAL = 60  # seconds, batches complete within a 24h window
+MAX_EMBEDDING_TOKENS = 8191  # Input limit of the embedding model
+FALLBACK_CHARS_PER_PIECE = MAX_EMBEDDING_TOKENS * 2  # Conservative without tiktoken
+
+
+def split_for_embedding(content: str) -> List[Union[str, List[int]]]:
+    """
+    Split content into pieces that fit the embedding model's input limit.
+    With tiktoken, pieces are token id lists (accepted as input by the API), so
+    the limit is exact; otherwise content is split by a conservative length.
+    """
+    if not ENCODING:
+        step = FALLBACK_CHARS_PER_PIECE
+        return [content[i : i + step] for i in range(0, len(content), step)]
+
+    tokens = ENCODING.encode(content)
+    return [
+        tokens[i : i + MAX_EMBEDDING_TOKENS]
+        for i in range(0, len(tokens), MAX_EMBEDDING_TOKENS)
+    ]
+
+
+def write_batch_input(filepaths: List[str]) -> str:
+    """
+    Write embeddings requests to a JSONL batch input file.
+    Long articles are split into pieces with custom_id "<slug>-<n>".
+    """
+    with open(BATCH_INPUT_FILE, "wb") as out:
+        for filepath in filepaths:
+            with open(filepath, "r", encoding="utf-8") as f:
+                content = f.read()
+
+            slug = os.path.splitext(os.path.basename(filepath))[0]
+            for n, piece in enumerate(split_for_embedding(content)):
+                request = {
+                    "custom_id": f"{slug}-{n}",
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {"model": EMBEDDING_MODEL, "input": piece},
+                }
+                out.write(orjson.dumps(request) + b"\n")
+
+    return BATCH_INPUT_FILE
+
+
+def submit_embeddings_batch(filepaths: List[str]):
+    """Upload the batch input file and create an embeddings batch job."""
+    input_path = write_batch_input(filepaths)
+    with open(input_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/embeddings",
+        completion_window="24h",
+    )
+    print(f"Submitted embeddings batch {batch.id} for {len(filepaths)} articles")
+    return batch
+
+
+def wait_for_batch(batch_id: str):
+    """Poll a batch job until it leaves the pending states."""
+    batch = client.batches.retrieve(batch_id)
+    while batch.status in ["validating", "in_progress", "finalizing"]:
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch_id)
+    return batch
+
+
+def backfill_embeddings(files_to_upload: Dict) -> Optional[str]:
+    """
+    Embed all saved articles through the Batch API.
+    Returns the path of the downloaded embeddings JSONL, or None on failure.
+    """
+    filepaths = [p for file_list in files_to_upload.values() for p in file_list]
+    if not filepaths:
+        return None
+
+    batch = wait_for_batch(submit_embeddings_batch(filepaths).id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        print(f"Embeddings batch ended with status: {batch.status}")
+        return None
+
+    if batch.request_counts and batch.request_counts.failed:
+        print(f"Warning: {batch.request_counts.failed} embedding requests failed")
+
+    client.files.content(batch.output_file_id).write_to_file(EMBEDDINGS_FILE)
+    print(f"Saved embeddings to {EMBEDDINGS_FILE}")
+    return EMBEDDINGS_FILE
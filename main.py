@@ -3,19 +3,35 @@
 Main script to scrape articles and upload them to OpenAI with delta detection.
 """
 
+import argparse
 import os
 import sys
 from dotenv import load_dotenv
-from scraper import fetch_articles_with_delta
+from scraper import fetch_articles_with_delta, load_state
 from uploader import upload_and_attach_delta
+from embeddings import backfill_embeddings
 
 load_dotenv()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="On the first run, also embed all articles through the OpenAI Batch API",
+    )
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     print("🚀 Starting delta-enabled article scraping and upload process...")
 
     try:
+        # The Batch API backfill only applies when there is no previous state
+        is_first_run = not load_state().get("articles")
+
         # Fetch articles and detect changes in one call
         files_to_upload, counts = fetch_articles_with_delta()
 
@@ -26,6 +42,13 @@ def main():
         print("☁️ Uploading changes to OpenAI vector store...")
         vector_store_id = upload_and_attach_delta(files_to_upload, counts)
 
+        if args.bulk:
+            if is_first_run:
+                print("📦 Backfilling embeddings through the Batch API...")
+                backfill_embeddings(files_to_upload)
+            else:
+                print("ℹ️ --bulk only applies to the first run, skipping backfill")
+
         print("✅ Process completed successfully!")
         print(f"📍 Vector store ID: {vector_store_id}")
 
@@ -1,16 +1,54 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+import soupsieve
+from markdownify import MarkdownConverter
 import os
-import json
-import hashlib
+import orjson
+import xxhash
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from chunking import chunks_for_tokens, count_tokens
 
 URL = "https://support.optisigns.com/api/v2/help_center/en-us/articles.json"
 STATE_FILE = "data/articles_state.json"
 ARTICLES_PER_PAGE = 30
 DEFAULT_MAX_PAGES = 2
+REQUEST_TIMEOUT = (5, 30)  # (connect, read) seconds
+FETCH_WORKERS = 8
+PREFETCH_WINDOW = 4  # Pages per batch when the API omits page_count
+
+# Navigation and ad elements stripped from article bodies
+UNWANTED_NAMES = ["nav", "navigation", "ad", "ads", "advertisement"]
+# Compiled once so each article only pays for the tree walk
+UNWANTED_SELECTOR = soupsieve.compile(
+    ", ".join(
+        ["nav", "footer"]
+        + [f".{name}" for name in UNWANTED_NAMES]
+        + [f"#{name}" for name in UNWANTED_NAMES]
+    )
+)
+
+# Shared converter so per-tag conversion lookups are cached across articles
+MARKDOWN_CONVERTER = MarkdownConverter()
+
+# Reuse one session so pages share a keep-alive connection
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=FETCH_WORKERS,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,  # Let callers handle the final status code
+        ),
+    ),
+)
 
 
 def ensure_data_dir():
@@ -23,8 +61,8 @@ def load_state() -> Dict:
     """Load the previous state of articles."""
     ensure_data_dir()
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(STATE_FILE, "rb") as f:
+            return orjson.loads(f.read())
     return {"articles": {}, "last_run": None}
 
 
@@ -32,55 +70,101 @@ def save_state(state: Dict):
     """Save the current state of articles."""
     ensure_data_dir()
     state["last_run"] = datetime.now().isoformat()
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2, ensure_ascii=False)
+    with open(STATE_FILE, "wb") as f:
+        f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2))
 
 
 def calculate_content_hash(article: Dict) -> str:
-    """Calculate hash of article content for change detection."""
-    content_for_hash = (
-        f"{article['title']}{article['body']}{article.get('updated_at', '')}"
+    """
+    Calculate hash of article content for change detection.
+    Uses xxh3_64 since no cryptographic guarantees are needed. MD5 hashes from
+    older state files are kept until the article's updated_at changes.
+    """
+    hasher = xxhash.xxh3_64()
+    hasher.update(article["title"].encode("utf-8"))
+    hasher.update(article["body"].encode("utf-8"))
+    hasher.update((article.get("updated_at") or "").encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def has_same_timestamp(article: Dict, previous: Dict) -> bool:
+    """Check whether the article's updated_at matches the stored state."""
+    updated_at = article.get("updated_at")
+    return bool(updated_at) and updated_at == previous.get("updated_at")
+
+
+def fetch_page(page: int) -> Optional[Dict]:
+    """Fetch a single page of articles. Returns None on HTTP error."""
+    print(f"Fetching page {page}...")
+    response = SESSION.get(
+        URL,
+        params={
+            "per_page": ARTICLES_PER_PAGE,
+            "page": page,
+            "sort_by": "updated_at",
+            "sort_order": "desc",
+        },
+        timeout=REQUEST_TIMEOUT,
     )
-    return hashlib.md5(content_for_hash.encode("utf-8")).hexdigest()
+
+    if response.status_code != 200:
+        print(f"Error fetching page {page}: {response.status_code}")
+        return None
+
+    return orjson.loads(response.content)
 
 
 def fetch_all_articles(max_pages: int = 10) -> List[Dict]:
     """Fetch articles with pagination until we get all recent updates."""
     all_articles = []
-    page = 1
+    pages_fetched = 0
     per_page = ARTICLES_PER_PAGE
 
-    while page <= max_pages:
-        print(f"Fetching page {page}...")
-        response = requests.get(
-            URL,
-            params={
-                "per_page": per_page,
-                "page": page,
-                "sort_by": "updated_at",
-                "sort_order": "desc",
-            },
-        )
-
-        if response.status_code != 200:
-            print(f"Error fetching page {page}: {response.status_code}")
-            break
-
-        data = response.json()
-        articles = data.get("articles", [])
-
-        if not articles:  # No more articles
-            break
-
-        all_articles.extend(articles)
-
-        # If we got fewer articles than requested, we've reached the end
-        if len(articles) < per_page:
-            break
-
-        page += 1
-
-    print(f"Fetched {len(all_articles)} total articles from {page-1} pages")
+    # Fetch the first page synchronously to learn the total page count
+    pending = [fetch_page(1)]
+    last_requested = 1
+
+    page_count = pending[0].get("page_count") if pending[0] else None
+    if page_count:
+        # Remaining pages are known up front, fetch them all at once
+        last_page = min(page_count, max_pages)
+        window = last_page
+    else:
+        # Unknown total, prefetch a few pages at a time
+        last_page = max_pages
+        window = PREFETCH_WINDOW
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        while pending:
+            reached_end = False
+            for data in pending:
+                if data is None:
+                    reached_end = True
+                    break
+
+                articles = data.get("articles", [])
+                if not articles:  # No more articles
+                    reached_end = True
+                    break
+
+                all_articles.extend(articles)
+                pages_fetched += 1
+
+                # If we got fewer articles than requested, we've reached the end
+                if len(articles) < per_page:
+                    reached_end = True
+                    break
+
+            if reached_end or last_requested >= last_page:
+                break
+
+            pages = range(
+                last_requested + 1, min(last_requested + window, last_page) + 1
+            )
+            pending = list(executor.map(fetch_page, pages))
+            last_requested = pages[-1]
+
+    print(f"Fetched {len(all_articles)} total articles from {pages_fetched} pages")
     return all_articles
 
 
@@ -92,96 +176,165 @@ def detect_article_changes(
     Returns: (new_articles, updated_articles, skipped_articles)
     """
     previous_articles = previous_state.get("articles", {})
+    current_articles = {str(article["id"]): article for article in articles}
+
+    current_ids = set(current_articles)
+    new_ids = current_ids - set(previous_articles)
+    common_ids = current_ids - new_ids
+
+    # Only hash articles whose updated_at changed (or is missing)
+    updated_ids = {
+        article_id
+        for article_id in common_ids
+        if not has_same_timestamp(
+            current_articles[article_id], previous_articles[article_id]
+        )
+        and previous_articles[article_id]["hash"]
+        != calculate_content_hash(current_articles[article_id])
+    }
 
-    new_articles = []
-    updated_articles = []
-    skipped_articles = []
-
-    for article in articles:
-        article_id = str(article["id"])
-        current_hash = calculate_content_hash(article)
-
-        if article_id not in previous_articles:
-            # New article
-            new_articles.append(article)
-        elif previous_articles[article_id]["hash"] != current_hash:
-            # Updated article
-            updated_articles.append(article)
-        else:
-            # Unchanged article
-            skipped_articles.append(article)
+    # Build the result lists in fetch order
+    new_articles = [a for i, a in current_articles.items() if i in new_ids]
+    updated_articles = [a for i, a in current_articles.items() if i in updated_ids]
+    skipped_articles = [
+        a
+        for i, a in current_articles.items()
+        if i not in new_ids and i not in updated_ids
+    ]
 
     return new_articles, updated_articles, skipped_articles
 
 
-def to_markdown(article: Dict) -> Tuple[str, str]:
-    """Convert article to markdown format."""
+def to_markdown(article: Dict) -> Tuple[str, str, str]:
+    """
+    Convert article to markdown format.
+    Returns: (slug, header, body) so callers can write the parts without
+    concatenating them into one large string.
+    """
     title = article["title"]
     html = article["body"]
     slug = str(article["id"])
 
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, "lxml")
 
-    # Remove unwanted elements
-    for element in soup.find_all(["nav", "footer"]):
+    # Remove unwanted elements in a single tree walk
+    for element in UNWANTED_SELECTOR.select(soup):
         element.decompose()
 
-    for element in soup.find_all(
-        class_=["nav", "navigation", "ad", "ads", "advertisement"]
-    ):
-        element.decompose()
+    # Convert the cleaned tree directly instead of re-serializing it to HTML
+    # and letting markdownify parse it a second time.
+    markdown = MARKDOWN_CONVERTER.convert_soup(soup)
 
-    for element in soup.find_all(
-        id=["nav", "navigation", "ad", "ads", "advertisement"]
-    ):
-        element.decompose()
+    return slug, f"# {title}\n\n", markdown
 
-    cleaned_html = str(soup)
-    markdown = md(cleaned_html)
 
-    return slug, f"# {title}\n\n{markdown}"
+def render_article(article: Dict) -> Tuple[str, str, str, Optional[int]]:
+    """
+    Render an article and count its tokens while the markdown is in memory.
+    Returns: (slug, header, body, token_count)
+    """
+    slug, header, body = to_markdown(article)
+    return slug, header, body, count_tokens(header, body)
 
 
-def save_articles_delta(new_articles: List[Dict], updated_articles: List[Dict]) -> Dict:
+def save_articles_delta(
+    new_articles: List[Dict], updated_articles: List[Dict]
+) -> Tuple[Dict, Dict[str, int]]:
     """
     Save only new and updated articles to files.
-    Returns dictionary with file paths for upload.
+    Returns: (files_to_upload, token_counts) where token_counts maps article id
+    to its token count.
     """
     ensure_data_dir()
 
     files_to_upload = {"new": [], "updated": []}
-
-    # Process new articles
-    for article in new_articles:
-        slug, content = to_markdown(article)
-        filepath = f"articles/{slug}.md"
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(content)
-        files_to_upload["new"].append(filepath)
-
-    # Process updated articles
-    for article in updated_articles:
-        slug, content = to_markdown(article)
+    token_counts = {}
+    changed_articles = new_articles + updated_articles
+
+    if not changed_articles:
+        return files_to_upload, token_counts
+
+    # Rendering is CPU-bound, so fan it out across processes
+    if len(changed_articles) > 1:
+        # Workers are forked eagerly, so don't start more than there is work for
+        max_workers = min(os.cpu_count() or 1, len(changed_articles))
+        chunksize = max(1, len(changed_articles) // (max_workers * 4))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rendered = list(
+                executor.map(render_article, changed_articles, chunksize=chunksize)
+            )
+    else:
+        rendered = [render_article(article) for article in changed_articles]
+
+    # Write files in the parent, preserving new/updated ordering
+    for i, (slug, header, body, token_count) in enumerate(rendered):
         filepath = f"articles/{slug}.md"
         with open(filepath, "w", encoding="utf-8") as f:
-            f.write(content)
-        files_to_upload["updated"].append(filepath)
+            f.write(header)
+            f.write(body)
+        key = "new" if i < len(new_articles) else "updated"
+        files_to_upload[key].append(filepath)
+        if token_count is not None:
+            token_counts[slug] = token_count
 
-    return files_to_upload
+    return files_to_upload, token_counts
 
 
-def update_state_with_articles(state: Dict, all_articles: List[Dict]) -> Dict:
-    """Update state with current article information."""
+def update_state_with_articles(
+    state: Dict, all_articles: List[Dict], token_counts: Optional[Dict] = None
+) -> Dict:
+    """
+    Update state with current article information.
+    Token and chunk counts are taken from token_counts for rendered articles and
+    carried over from the previous entry when the content hash is unchanged.
+    """
+    token_counts = token_counts or {}
     for article in all_articles:
         article_id = str(article["id"])
-        state["articles"][article_id] = {
-            "hash": calculate_content_hash(article),
+        previous = state["articles"].get(article_id)
+        if previous and has_same_timestamp(article, previous):
+            content_hash = previous["hash"]
+        else:
+            content_hash = calculate_content_hash(article)
+
+        if article_id in token_counts:
+            token_count = token_counts[article_id]
+        elif previous and previous["hash"] == content_hash:
+            token_count = previous.get("token_count")
+        else:
+            token_count = None
+
+        entry = {
+            "hash": content_hash,
             "updated_at": article.get("updated_at"),
             "title": article["title"],
         }
+        if token_count is not None:
+            entry["token_count"] = token_count
+            entry["chunk_count"] = chunks_for_tokens(token_count)
+
+        state["articles"][article_id] = entry
     return state
 
 
+def mark_articles_for_retry(new_ids: List[str], updated_ids: List[str]):
+    """
+    Make articles whose upload failed get picked up again on the next run.
+    New articles are dropped from state so they are detected as new again;
+    updated articles have their hash and updated_at cleared so they are
+    detected as updated instead of skipped.
+    """
+    state = load_state()
+    for article_id in new_ids:
+        state["articles"].pop(article_id, None)
+    for article_id in updated_ids:
+        entry = state["articles"].get(article_id)
+        if entry:
+            entry["hash"] = None
+            entry["updated_at"] = None
+    save_state(state)
+
+
 def fetch_articles_with_delta() -> Tuple[Dict, Dict]:
     """
     Main function to fetch articles and detect changes.
@@ -199,10 +352,14 @@ def fetch_articles_with_delta() -> Tuple[Dict, Dict]:
     )
 
     # Save only changed articles to files
-    files_to_upload = save_articles_delta(new_articles, updated_articles)
+    files_to_upload, token_counts = save_articles_delta(
+        new_articles, updated_articles
+    )
 
     # Update and save state
-    updated_state = update_state_with_articles(previous_state, all_articles)
+    updated_state = update_state_with_articles(
+        previous_state, all_articles, token_counts
+    )
     save_state(updated_state)
 
     # Prepare counts for logging at upload stage
@@ -1,10 +1,12 @@
+import asyncio
+import httpx
 import openai
 import os
-import time
-import tiktoken
 from dotenv import load_dotenv
-from typing import Dict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
+from pathlib import Path
+from chunking import ENCODING, chunks_for_tokens, estimate_file_chunks
+from scraper import load_state, mark_articles_for_retry
 
 load_dotenv()
 
@@ -12,13 +14,20 @@ api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise ValueError("OPENAI_API_KEY environment variable is not set")
 
-client = openai.OpenAI(api_key=api_key)
+UPLOAD_CONCURRENCY = 16
+# The SDK retries 429/5xx responses with exponential backoff
+MAX_RETRIES = 5
 
-# Initialize tiktoken encoding once (expensive operation)
-try:
-    ENCODING = tiktoken.get_encoding("cl100k_base")
-except Exception:
-    ENCODING = None
+# HTTP/2 lets concurrent requests share one multiplexed connection
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+HTTP_TIMEOUT = 60.0
+
+client = openai.OpenAI(
+    api_key=api_key,
+    http_client=openai.DefaultHttpxClient(
+        http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT
+    ),
+)
 
 
 def get_existing_vector_store(name: str = "OptiBot Docs"):
@@ -38,32 +47,29 @@ def get_existing_vector_store(name: str = "OptiBot Docs"):
     return client.vector_stores.create(name=name)
 
 
-def get_existing_files_in_vector_store(vector_store_id: str) -> Dict[str, str]:
-    """Get mapping of filename to file_id for existing files in vector store - OPTIMIZED."""
+def get_existing_files_in_vector_store(vector_store_id: str) -> Dict[str, List[str]]:
+    """
+    Get mapping of filename to file_ids for existing files in vector store - OPTIMIZED.
+    A filename can map to several ids when stale copies were left behind.
+    """
     existing_files = {}
     try:
-        # Use batch retrieval with pagination for better performance
-        files_in_store = client.vector_stores.files.list(
-            vector_store_id=vector_store_id, limit=100  # Get more files per request
-        )
-
-        # Batch file details retrieval
-        file_ids = [file_obj.id for file_obj in files_in_store.data]
+        # Iterating a cursor page follows `after` cursors automatically, so
+        # both listings take O(N / limit) requests instead of one per file
+        store_file_ids = {
+            file_obj.id
+            for file_obj in client.vector_stores.files.list(
+                vector_store_id=vector_store_id, limit=100
+            )
+        }
 
-        # Use ThreadPoolExecutor for parallel file detail retrieval
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_id = {
-                executor.submit(client.files.retrieve, file_id): file_id
-                for file_id in file_ids
-            }
+        if not store_file_ids:
+            return existing_files
 
-            for future in as_completed(future_to_id):
-                try:
-                    file_details = future.result()
-                    if hasattr(file_details, "filename"):
-                        existing_files[file_details.filename] = file_details.id
-                except Exception as e:
-                    print(f"Error retrieving file details: {e}")
+        # Resolve filenames from one bulk listing instead of per-file retrieves
+        for file_obj in client.files.list(purpose="assistants", limit=10000):
+            if file_obj.id in store_file_ids:
+                existing_files.setdefault(file_obj.filename, []).append(file_obj.id)
 
     except Exception as e:
         print(f"Error getting existing files: {e}")
@@ -71,33 +77,121 @@ def get_existing_files_in_vector_store(vector_store_id: str) -> Dict[str, str]:
     return existing_files
 
 
-def upload_files_parallel(filepaths: list) -> list:
-    """Upload multiple files in parallel for better performance."""
-    uploaded_files = []
-
-    def upload_single_file(filepath):
-        try:
-            with open(filepath, "rb") as f:
-                return client.files.create(file=f, purpose="assistants")
-        except Exception as e:
-            print(f"Error uploading {filepath}: {e}")
-            return None
-
-    # Use ThreadPoolExecutor for parallel uploads
-    with ThreadPoolExecutor(
-        max_workers=3
-    ) as executor:  # Conservative limit to avoid rate limits
-        future_to_path = {
-            executor.submit(upload_single_file, filepath): filepath
-            for filepath in filepaths
+async def remove_files(aclient, vector_store_id: str, file_ids: list):
+    """Remove files from the vector store concurrently."""
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def remove_file(file_id):
+        async with semaphore:
+            try:
+                await aclient.vector_stores.files.delete(
+                    file_id=file_id, vector_store_id=vector_store_id
+                )
+            except Exception as e:
+                print(f"Warning: Could not remove file {file_id}: {e}")
+
+    await asyncio.gather(*(remove_file(file_id) for file_id in file_ids))
+
+
+async def upload_files(aclient, filepaths: list) -> Dict[str, str]:
+    """
+    Upload files concurrently, logging failures instead of aborting the run.
+    Returns mapping of filepath to file_id for successful uploads.
+    """
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def upload_file(filepath):
+        async with semaphore:
+            # Read each file once and hand the SDK a (filename, bytes) pair
+            return await aclient.files.create(
+                file=(os.path.basename(filepath), Path(filepath).read_bytes()),
+                purpose="assistants",
+            )
+
+    results = await asyncio.gather(
+        *(upload_file(filepath) for filepath in filepaths), return_exceptions=True
+    )
+
+    uploaded = {}
+    for filepath, result in zip(filepaths, results):
+        if isinstance(result, BaseException):
+            print(f"Error uploading {filepath}: {result}")
+        else:
+            uploaded[filepath] = result.id
+
+    return uploaded
+
+
+async def upload_and_replace_files(
+    vector_store_id: str, filepaths: list, replaced_files: Dict[str, List[str]]
+):
+    """
+    Upload files to the vector store, then remove the versions they replace.
+    Runs on one event loop so many requests can be in flight at once.
+    Returns: (uploaded, completed) mapping filepath to the new file_id for files
+    that uploaded, and for those whose vector store processing completed.
+    """
+    async with openai.AsyncOpenAI(
+        api_key=api_key,
+        max_retries=MAX_RETRIES,
+        http_client=openai.DefaultAsyncHttpxClient(
+            http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT
+        ),
+    ) as aclient:
+        print(f"Uploading {len(filepaths)} files to OpenAI storage...")
+        uploaded = await upload_files(aclient, filepaths)
+
+        if not uploaded:
+            print("No files were uploaded successfully")
+            return uploaded, {}
+
+        # Attach the successful uploads in one batch. Polling is left to the
+        # SDK, which follows the server's openai-poll-after-ms hint
+        print(f"Adding {len(uploaded)} files to vector store...")
+        batch = await aclient.vector_stores.file_batches.create_and_poll(
+            vector_store_id=vector_store_id, file_ids=list(uploaded.values())
+        )
+
+        if batch.status != "completed":
+            print(f"Batch processing failed with status: {batch.status}")
+
+        # Per-file results decide which replacements actually landed
+        completed_ids = {
+            vs_file.id
+            async for vs_file in aclient.vector_stores.file_batches.list_files(
+                batch.id, vector_store_id=vector_store_id, filter="completed"
+            )
         }
+        completed = {
+            filepath: file_id
+            for filepath, file_id in uploaded.items()
+            if file_id in completed_ids
+        }
+        print(f"Successfully processed {len(completed)} files")
+
+        # Garbage-collect old versions only for files whose new version is in
+        # place, so a failed file keeps its previous version searchable
+        files_to_remove = [
+            old_id
+            for filepath in completed
+            for old_id in replaced_files.get(os.path.basename(filepath), [])
+        ]
+        if files_to_remove:
+            print(f"Removing {len(files_to_remove)} old file versions...")
+            await remove_files(aclient, vector_store_id, files_to_remove)
+
+        if len(completed) < len(uploaded):
+            print(
+                f"Keeping old versions of {len(uploaded) - len(completed)} files "
+                "that failed to process"
+            )
 
-        for future in as_completed(future_to_path):
-            result = future.result()
-            if result:
-                uploaded_files.append(result)
+    return uploaded, completed
 
-    return uploaded_files
+
+def slug_for(filepath: str) -> str:
+    """Get the article id a markdown file was saved under."""
+    return os.path.splitext(os.path.basename(filepath))[0]
 
 
 def upload_files_delta(files_to_upload: Dict, vector_store_id: str) -> Dict:
@@ -107,9 +201,6 @@ def upload_files_delta(files_to_upload: Dict, vector_store_id: str) -> Dict:
     # Get existing files in vector store (already optimized)
     existing_files = get_existing_files_in_vector_store(vector_store_id)
 
-    all_file_ids = []
-    files_to_remove = []
-
     # Collect all files to upload
     new_files = files_to_upload.get("new", [])
     updated_files = files_to_upload.get("updated", [])
@@ -118,61 +209,30 @@ def upload_files_delta(files_to_upload: Dict, vector_store_id: str) -> Dict:
     if not all_files_to_upload:
         return upload_counts
 
-    # Mark old updated files for removal (batch operation later)
-    for filepath in updated_files:
-        filename = os.path.basename(filepath)
-        if filename in existing_files:
-            files_to_remove.append(existing_files[filename])
-
-    # Remove old files in parallel (for updated files)
-    if files_to_remove:
-        print(f"Removing {len(files_to_remove)} old file versions...")
-
-        def remove_file(file_id):
-            try:
-                client.vector_stores.files.delete(
-                    file_id=file_id, vector_store_id=vector_store_id
-                )
-            except Exception as e:
-                print(f"Warning: Could not remove file {file_id}: {e}")
-
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            list(executor.map(remove_file, files_to_remove))
-
-    # Upload all files in parallel
-    print(f"Uploading {len(all_files_to_upload)} files to OpenAI storage...")
-    uploaded_files = upload_files_parallel(all_files_to_upload)
-
-    # Collect file IDs and update counts
-    for i, uploaded_file in enumerate(uploaded_files):
-        if uploaded_file:
-            all_file_ids.append(uploaded_file.id)
-            if i < len(new_files):
-                upload_counts["added"] += 1
-            else:
-                upload_counts["updated"] += 1
-
-    # Add files to vector store in one batch
-    if all_file_ids:
-        print(f"Adding {len(all_file_ids)} files to vector store...")
-        batch = client.vector_stores.file_batches.create(
-            vector_store_id=vector_store_id, file_ids=all_file_ids
-        )
-
-        # Optimized status checking with exponential backoff
-        wait_time = 1
-        max_wait = 30
-        while batch.status in ["queued", "in_progress"]:
-            time.sleep(wait_time)
-            batch = client.vector_stores.file_batches.retrieve(
-                vector_store_id=vector_store_id, batch_id=batch.id
-            )
-            wait_time = min(wait_time * 1.5, max_wait)  # Exponential backoff
-
-        if batch.status == "completed":
-            print(f"Successfully processed {len(all_file_ids)} files")
-        else:
-            print(f"Batch processing failed with status: {batch.status}")
+    # Any existing copy of a file being uploaded becomes an orphan once the new
+    # version lands, including copies left behind by earlier failed runs
+    replaced_files = {
+        filename: existing_files[filename]
+        for filename in set(existing_files)
+        & {os.path.basename(p) for p in all_files_to_upload}
+    }
+
+    _, completed = asyncio.run(
+        upload_and_replace_files(vector_store_id, all_files_to_upload, replaced_files)
+    )
+
+    # Only files whose vector store processing completed count as uploaded;
+    # this also covers batches that ended in a non-completed status
+    upload_counts["added"] = sum(1 for p in new_files if p in completed)
+    upload_counts["updated"] = sum(1 for p in updated_files if p in completed)
+
+    # State was saved before uploading, so make failed articles retry next run
+    failed_new = [slug_for(p) for p in new_files if p not in completed]
+    failed_updated = [slug_for(p) for p in updated_files if p not in completed]
+    if failed_new or failed_updated:
+        failed_count = len(failed_new) + len(failed_updated)
+        print(f"Warning: {failed_count} files failed and will be retried next run")
+        mark_articles_for_retry(failed_new, failed_updated)
 
     # Calculate chunk estimates (optimized)
     upload_counts["total_chunks"] = estimate_chunks_for_files(files_to_upload)
@@ -182,47 +242,29 @@ def upload_files_delta(files_to_upload: Dict, vector_store_id: str) -> Dict:
 
 def estimate_chunks_for_files(files_to_upload: Dict) -> int:
     """Estimate total chunks for uploaded files using tiktoken - OPTIMIZED."""
-    if not ENCODING:
-        return estimate_chunks_fallback(files_to_upload)
+    # Chunk counts are computed in the render pool and cached in state, so with
+    # tiktoken loaded files are only read back here when their state entry is
+    # gone, i.e. new articles dropped by mark_articles_for_retry
+    articles_state = load_state().get("articles", {})
 
     total_chunks = 0
-
-    def process_file(filepath):
-        try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                content = f.read()
-
-            # Get exact token count
-            tokens = ENCODING.encode(content)
-            token_count = len(tokens)
-
-            # Calculate chunks based on OpenAI's strategy:
-            # - max_chunk_size_tokens: 800
-            # - chunk_overlap_tokens: 400
-            # - Effective progression: 400 tokens per chunk (after first)
-            if token_count <= 800:
-                return 1
+    uncached_files = []
+    for file_list in files_to_upload.values():
+        for filepath in file_list:
+            chunk_count = articles_state.get(slug_for(filepath), {}).get("chunk_count")
+            if chunk_count is None:
+                uncached_files.append(filepath)
             else:
-                remaining_tokens = token_count - 800
-                additional_chunks = (remaining_tokens + 399) // 400  # Ceiling division
-                return 1 + additional_chunks
+                total_chunks += chunk_count
 
-        except Exception:
-            return 1  # Fallback
+    if not uncached_files:
+        return total_chunks
 
-    # Process files in parallel for faster token counting
-    all_files = []
-    for file_list in files_to_upload.values():
-        all_files.extend(file_list)
+    if not ENCODING:
+        return total_chunks + estimate_chunks_fallback({"uncached": uncached_files})
 
-    if len(all_files) > 5:  # Only use threading for multiple files
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            chunk_counts = list(executor.map(process_file, all_files))
-            total_chunks = sum(chunk_counts)
-    else:
-        # For few files, sequential processing is faster
-        for filepath in all_files:
-            total_chunks += process_file(filepath)
+    for filepath in uncached_files:
+        total_chunks += estimate_file_chunks(filepath)
 
     return total_chunks
 
@@ -237,13 +279,7 @@ def estimate_chunks_fallback(files_to_upload: Dict) -> int:
                 file_size = os.path.getsize(filepath)
                 # Updated estimation based on OpenAI's chunking strategy
                 estimated_tokens = file_size // 4  # ~4 chars per token
-                if estimated_tokens <= 800:
-                    chunks = 1
-                else:
-                    remaining_tokens = estimated_tokens - 800
-                    additional_chunks = (remaining_tokens + 399) // 400
-                    chunks = 1 + additional_chunks
-                total_chunks += chunks
+                total_chunks += chunks_for_tokens(estimated_tokens)
             except Exception:
                 total_chunks += 1
 